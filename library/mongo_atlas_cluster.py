@@ -1,23 +1,106 @@
 #!/usr/bin/env python
 from ansible.module_utils.basic import AnsibleModule
-import requests
-from requests.auth import HTTPDigestAuth
 
-
-def delete_cluster(atlas_username, atlas_api_key, atlas_group_id, name):
-    url = "https://cloud.mongodb.com/api/atlas/v1.0/groups/" + atlas_group_id \
-        + "/clusters/" + name
-    response = requests.delete(url, auth=HTTPDigestAuth(atlas_username,
-                                                        atlas_api_key))
-
-    delete_json = response.json()
-    response.close()
-    return delete_json
-
-
-def create_cluster(atlas_username, atlas_api_key, atlas_group_id, name,
-                   num_shards, replication_factor, instance_size, disk_iops,
-                   encrypt, backup_enabled, region_name, disk_size):
+# orjson is a faster drop-in when available; json.loads accepts bytes too
+try:
+    from orjson import dumps as _dumps, loads as _loads
+except ImportError:
+    from json import dumps as _dumps, loads as _loads
+
+_ARGSPEC_CLUSTER = dict(
+    atlas_username=dict(required=True, type='str'),
+    atlas_api_key=dict(required=True, type='str', no_log=True),
+    atlas_group_id=dict(required=True, type='str'),
+    name=dict(required=True, type='str'),
+    num_shards=dict(required=False, type='int', default=1),
+    replication_factor=dict(required=False, type='int', default=3),
+    instance_size=dict(required=False, type='str', default='M10'),
+    disk_iops=dict(required=False, type='int'),
+    encrypt=dict(required=False, type='bool'),
+    backup_enabled=dict(required=False, default=True, type='bool'),
+    region_name=dict(required=False, default='US_EAST_1', type='str'),
+    state=dict(default='present', choices=['absent', 'present']),
+    disk_size=dict(type='int')
+)
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+_API_URL = "https://cloud.mongodb.com/api/atlas/v1.0"
+
+# (connect, read) timeout in seconds passed to every Atlas API call
+_TIMEOUT = (3.05, 30)
+
+# Created by _connect() on first use and reused after that. requests is only
+# imported there, which saves the import on runs that exit before calling
+# Atlas, i.e. when the arguments fail validation.
+_SESSION = None
+
+
+def _new_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    class AtlasRetry(Retry):
+        def is_retry(self, method, status_code, has_retry_after=False):
+            # Atlas rejects a rate limited request before processing it, so
+            # a 429 is safe to retry whatever the method
+            if status_code == 429:
+                return True
+            return super().is_retry(method, status_code, has_retry_after)
+
+    # Atlas rate limits aggressively, so back off and retry on 429 and
+    # gateway errors. A write may already have been applied when a gateway
+    # error or read timeout comes back, so those are only retried for GETs.
+    # The last response is still returned, not raised, so callers can report
+    # the error JSON from Atlas as before.
+    retry_args = dict(total=5, backoff_factor=0.5,
+                      respect_retry_after_header=True,
+                      status_forcelist=[429, 502, 503, 504],
+                      raise_on_status=False)
+    try:
+        retry = AtlasRetry(allowed_methods=['GET'], **retry_args)
+    except TypeError:
+        # urllib3 < 1.26 only knows this option as method_whitelist
+        retry = AtlasRetry(method_whitelist=['GET'], **retry_args)
+
+    # Every call goes to the same host, so share one keepalive connection
+    # pool
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                                          max_retries=retry))
+    return session
+
+
+def _connect(atlas_username, atlas_api_key):
+    global _SESSION
+    from requests.auth import HTTPDigestAuth
+
+    if _SESSION is None:
+        _SESSION = _new_session()
+
+    # Install fresh auth on every run so a reused interpreter never sends
+    # requests with an earlier task's credentials. Within a run keep this
+    # single instance: once it has seen the first 401 challenge it signs
+    # later requests up front from the cached nonce, so only the first call
+    # pays the extra round trip
+    _SESSION.auth = HTTPDigestAuth(atlas_username, atlas_api_key)
+    return _SESSION
+
+
+def _json(response):
+    return _loads(response.content)
+
+
+def delete_cluster(base_url, name):
+    url = f"{base_url}/clusters/{name}"
+    with _SESSION.delete(url, timeout=_TIMEOUT) as response:
+        return _json(response)
+
+
+def create_cluster(base_url, name, num_shards, replication_factor,
+                   instance_size, disk_iops, encrypt, backup_enabled,
+                   region_name, disk_size):
     payload = dict(name=name)
     if backup_enabled is not None:
         payload['backupEnabled'] = backup_enabled
@@ -40,48 +123,27 @@ def create_cluster(atlas_username, atlas_api_key, atlas_group_id, name,
     if encrypt is not None:
         provider_settings['encryptEBSVolume'] = encrypt
 
-    url = "https://cloud.mongodb.com/api/atlas/v1.0/groups/" + atlas_group_id \
-        + "/clusters"
-
-    res = requests.post(url, json=payload, auth=HTTPDigestAuth(atlas_username,
-                                                               atlas_api_key))
+    url = f"{base_url}/clusters"
 
-    post_json = res.json()
-    res.close()
+    with _SESSION.post(url, data=_dumps(payload),
+                       headers=_JSON_HEADERS, timeout=_TIMEOUT) as response:
+        post_json = _json(response)
     post_json['url'] = url
     return post_json
 
 
-def get_cluster(atlas_username, atlas_api_key, atlas_group_id, name):
-    url = "https://cloud.mongodb.com/api/atlas/v1.0/groups/" + atlas_group_id \
-        + "/clusters/" + name
-    response = requests.get(url, auth=HTTPDigestAuth(atlas_username,
-                                                     atlas_api_key))
-    cluster_json = response.json()
-    response.close()
+def get_cluster(base_url, name):
+    url = f"{base_url}/clusters/{name}"
+    with _SESSION.get(url, timeout=_TIMEOUT) as response:
+        cluster_json = _json(response)
     cluster_json['url'] = url
     return cluster_json
 
 
 def main():
     module = AnsibleModule(
-            argument_spec=dict(
-                atlas_username=dict(required=True, type='str'),
-                atlas_api_key=dict(required=True, type='str', no_log=True),
-                atlas_group_id=dict(required=True, type='str'),
-                name=dict(required=True, type='str'),
-                num_shards=dict(required=False, type='int', default=1),
-                replication_factor=dict(required=False, type='int', default=3),
-                instance_size=dict(required=False, type='str', default='M10'),
-                disk_iops=dict(required=False, type='int'),
-                encrypt=dict(required=False, type='bool'),
-                backup_enabled=dict(required=False, default=True, type='bool'),
-                region_name=dict(required=False, default='US_EAST_1',
-                                 type='str'),
-                state=dict(default='present', choices=['absent', 'present']),
-                disk_size=dict(type='int')
-                ),
-            supports_check_mode=False
+            argument_spec=_ARGSPEC_CLUSTER,
+            supports_check_mode=True
             )
     atlas_username = module.params['atlas_username']
     atlas_api_key = module.params['atlas_api_key']
@@ -97,52 +159,60 @@ def main():
     state = module.params['state']
     disk_size = module.params['disk_size']
 
-    subject_cluster = get_cluster(atlas_username=atlas_username,
-                                  atlas_api_key=atlas_api_key,
-                                  atlas_group_id=atlas_group_id,
-                                  name=name)
+    _connect(atlas_username, atlas_api_key)
 
-    if subject_cluster.get('error') is None:
-        subject_state = 'present'
-    elif subject_cluster.get('error') == 404:
-        subject_state = 'absent'
-
-    if state == 'absent' and subject_state == 'absent':
-        module.exit_json(changed=False, cluster=name)
-        return
+    base_url = f"{_API_URL}/groups/{atlas_group_id}"
 
-    if state == 'present' and subject_state == 'absent':
-        cluster = create_cluster(atlas_username=atlas_username,
-                                 atlas_api_key=atlas_api_key,
-                                 atlas_group_id=atlas_group_id,
-                                 name=name,
-                                 num_shards=num_shards,
-                                 replication_factor=replication_factor,
-                                 instance_size=instance_size,
-                                 disk_iops=disk_iops,
-                                 encrypt=encrypt,
-                                 backup_enabled=backup_enabled,
-                                 region_name=region_name,
-                                 disk_size=disk_size)
-        if cluster.get('error') is not None:
-            module.fail_json(msg="Could not create cluster", response=cluster)
+    # Nothing may be changed in check mode, so look the cluster up and
+    # report what would happen
+    if module.check_mode:
+        subject_cluster = get_cluster(base_url=base_url, name=name)
+        if subject_cluster.get('error') is None:
+            module.exit_json(changed=state == 'absent',
+                             cluster=subject_cluster)
+        elif subject_cluster.get('error') == 404:
+            module.exit_json(changed=state == 'present', cluster=name)
         else:
-            module.exit_json(changed=True, cluster=cluster)
+            module.fail_json(msg="Could not get cluster",
+                             response=subject_cluster)
         return
 
-    if state == 'absent' and subject_state == 'present':
-        cluster = delete_cluster(atlas_username=atlas_username,
-                                 atlas_api_key=atlas_api_key,
-                                 atlas_group_id=atlas_group_id,
-                                 name=name)
-        if cluster.get('error') is not None:
-            module.fail_json(msg="Could not delete cluster", response=cluster)
-        else:
+    # The cluster is not wanted. Delete it straight away; a 404 means it was
+    # never there, so there is no need to look it up first.
+    if state == 'absent':
+        cluster = delete_cluster(base_url=base_url, name=name)
+        if cluster.get('error') is None:
             module.exit_json(changed=True, cluster=cluster)
+        elif cluster.get('error') == 404:
+            module.exit_json(changed=False, cluster=name)
+        else:
+            module.fail_json(msg="Could not delete cluster", response=cluster)
         return
 
-    if state == 'present' and subject_state == 'present':
+    # The cluster is wanted. Look it up first: on reruns it usually exists
+    # already, and then this GET is the only request we make.
+    subject_cluster = get_cluster(base_url=base_url, name=name)
+    if subject_cluster.get('error') is None:
         module.exit_json(changed=False, cluster=subject_cluster)
+        return
+    if subject_cluster.get('error') != 404:
+        module.fail_json(msg="Could not get cluster", response=subject_cluster)
+        return
+
+    cluster = create_cluster(base_url=base_url,
+                             name=name,
+                             num_shards=num_shards,
+                             replication_factor=replication_factor,
+                             instance_size=instance_size,
+                             disk_iops=disk_iops,
+                             encrypt=encrypt,
+                             backup_enabled=backup_enabled,
+                             region_name=region_name,
+                             disk_size=disk_size)
+    if cluster.get('error') is not None:
+        module.fail_json(msg="Could not create cluster", response=cluster)
+    else:
+        module.exit_json(changed=True, cluster=cluster)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 from ansible.module_utils.basic import AnsibleModule
-import requests
-from requests.auth import HTTPDigestAuth
+
+# orjson is a faster drop-in when available; json.loads accepts bytes too
+try:
+    from orjson import dumps as _dumps, loads as _loads
+except ImportError:
+    from json import dumps as _dumps, loads as _loads
 
 DOCUMENTATION = '''
 ---
@@ -77,6 +81,85 @@ EXAMPLES = '''
             role: read
 '''
 
+_ARGSPEC_USER = dict(
+    atlas_username=dict(required=True, type='str'),
+    atlas_api_key=dict(required=True, type='str', no_log=True),
+    atlas_group_id=dict(required=True, type='str'),
+    user=dict(required=True, type='str', no_log=False),
+    password=dict(required=False, type='str', no_log=True),
+    state=dict(default='present', choices=['absent', 'present']),
+    update_password=dict(default='always', choices=['always', 'on_create']),
+    roles=dict(default=None, type='list')
+)
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+_API_URL = "https://cloud.mongodb.com/api/atlas/v1.0"
+
+# (connect, read) timeout in seconds passed to every Atlas API call
+_TIMEOUT = (3.05, 30)
+
+# Created by _connect() on first use and reused after that. requests is only
+# imported there, which saves the import on runs that exit before calling
+# Atlas, i.e. when the arguments fail validation.
+_SESSION = None
+
+
+def _new_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    class AtlasRetry(Retry):
+        def is_retry(self, method, status_code, has_retry_after=False):
+            # Atlas rejects a rate limited request before processing it, so
+            # a 429 is safe to retry whatever the method
+            if status_code == 429:
+                return True
+            return super().is_retry(method, status_code, has_retry_after)
+
+    # Atlas rate limits aggressively, so back off and retry on 429 and
+    # gateway errors. A write may already have been applied when a gateway
+    # error or read timeout comes back, so those are only retried for GETs.
+    # The last response is still returned, not raised, so callers can report
+    # the error JSON from Atlas as before.
+    retry_args = dict(total=5, backoff_factor=0.5,
+                      respect_retry_after_header=True,
+                      status_forcelist=[429, 502, 503, 504],
+                      raise_on_status=False)
+    try:
+        retry = AtlasRetry(allowed_methods=['GET'], **retry_args)
+    except TypeError:
+        # urllib3 < 1.26 only knows this option as method_whitelist
+        retry = AtlasRetry(method_whitelist=['GET'], **retry_args)
+
+    # Every call goes to the same host, so share one keepalive connection
+    # pool
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                                          max_retries=retry))
+    return session
+
+
+def _connect(atlas_username, atlas_api_key):
+    global _SESSION
+    from requests.auth import HTTPDigestAuth
+
+    if _SESSION is None:
+        _SESSION = _new_session()
+
+    # Install fresh auth on every run so a reused interpreter never sends
+    # requests with an earlier task's credentials. Within a run keep this
+    # single instance: once it has seen the first 401 challenge it signs
+    # later requests up front from the cached nonce, so only the first call
+    # pays the extra round trip
+    _SESSION.auth = HTTPDigestAuth(atlas_username, atlas_api_key)
+    return _SESSION
+
+
+def _json(response):
+    return _loads(response.content)
+
 
 def map_roles(role):
     """ Transform roles into the format needed by the api """
@@ -102,7 +185,19 @@ def map_roles(role):
         return role
 
 
-def get_user(atlas_group_id, atlas_username, atlas_api_key, user):
+def role_key(role):
+    """ Reduce a role in the api format to a sortable, comparable tuple """
+    return (role.get('databaseName') or '', role.get('roleName') or '',
+            role.get('collectionName') or '')
+
+
+def roles_match(current_roles, roles_with_dbs):
+    """ Compare roles ignoring order, since Atlas does not keep it """
+    return sorted(map(role_key, current_roles)) == \
+        sorted(map(role_key, roles_with_dbs))
+
+
+def get_user(base_url, user):
     """
     Calls GET /api/atlas/v1.0/groups/GROUPID/databaseUsers/admin/USERNAME
 
@@ -110,50 +205,41 @@ def get_user(atlas_group_id, atlas_username, atlas_api_key, user):
         The JSON of the user object with the URL called to get it added as
         'url' in the JSON
     """
-    url = "https://cloud.mongodb.com/api/atlas/v1.0/groups/" + atlas_group_id \
-        + "/databaseUsers/admin/" + user
-    response = requests.get(url, auth=HTTPDigestAuth(atlas_username,
-                            atlas_api_key))
-    user_json = response.json()
-    response.close()
+    url = f"{base_url}/databaseUsers/admin/{user}"
+    with _SESSION.get(url, timeout=_TIMEOUT) as response:
+        user_json = _json(response)
     user_json['url'] = url
     return user_json
 
 
-def create_user(atlas_group_id, atlas_username, atlas_api_key, user, roles,
-                password):
-    roles_with_dbs = map(map_roles, roles)
-    url = "https://cloud.mongodb.com/api/atlas/v1.0/groups/" + atlas_group_id \
-        + "/databaseUsers"
+def create_user(base_url, atlas_group_id, user, roles, password):
+    roles_with_dbs = [map_roles(role) for role in roles]
+    url = f"{base_url}/databaseUsers"
     user = dict(databaseName='admin',
                 groupId=atlas_group_id,
                 username=user,
                 roles=roles_with_dbs,
                 password=password)
-    response = requests.post(url, json=user,
-                             auth=HTTPDigestAuth(atlas_username,
-                                                 atlas_api_key))
-    post_json = response.json()
-    response.close()
+    with _SESSION.post(url, data=_dumps(user),
+                       headers=_JSON_HEADERS, timeout=_TIMEOUT) as response:
+        post_json = _json(response)
     post_json['url'] = url
     return post_json
 
 
-def delete_user(atlas_group_id, atlas_username, atlas_api_key, user):
-    url = "https://cloud.mongodb.com/api/atlas/v1.0/groups/" + atlas_group_id \
-        + "/databaseUsers/admin/"+user
-    response = requests.delete(url, auth=HTTPDigestAuth(atlas_username,
-                                                        atlas_api_key))
-    delete_json = response.json()
-    response.close()
+def delete_user(base_url, user):
+    url = f"{base_url}/databaseUsers/admin/{user}"
+    with _SESSION.delete(url, timeout=_TIMEOUT) as response:
+        delete_json = _json(response)
     delete_json['url'] = url
     return delete_json
 
 
-def sync_user(atlas_group_id, atlas_username, atlas_api_key, user,
-              http_response, roles, password):
-    roles_with_dbs = map(map_roles, roles)
-    if http_response['roles'] == roles_with_dbs and password is None:
+def sync_user(base_url, atlas_group_id, user, http_response, roles,
+              password):
+    roles_with_dbs = [map_roles(role) for role in roles]
+    if password is None and roles_match(http_response['roles'],
+                                        roles_with_dbs):
         return dict(changed=False)
 
     payload = dict(databaseName='admin',
@@ -164,16 +250,12 @@ def sync_user(atlas_group_id, atlas_username, atlas_api_key, user,
     if password is not None:
         payload['password'] = password
 
-    url = "https://cloud.mongodb.com/api/atlas/v1.0/groups/" + atlas_group_id \
-        + "/databaseUsers/admin/"+user
-
-    response = requests.patch(url, json=payload, auth=HTTPDigestAuth(
-                              atlas_username,
-                              atlas_api_key))
+    url = f"{base_url}/databaseUsers/admin/{user}"
 
-    patch_json = response.json()
+    with _SESSION.patch(url, data=_dumps(payload),
+                        headers=_JSON_HEADERS, timeout=_TIMEOUT) as response:
+        patch_json = _json(response)
     patch_json['changed'] = True
-    response.close()
     patch_json['url'] = url
     return patch_json
 
@@ -181,18 +263,8 @@ def sync_user(atlas_group_id, atlas_username, atlas_api_key, user,
 def main():
     """Load the option and route the methods to call"""
     module = AnsibleModule(
-            argument_spec=dict(
-                atlas_username=dict(required=True, type='str'),
-                atlas_api_key=dict(required=True, type='str', no_log=True),
-                atlas_group_id=dict(required=True, type='str'),
-                user=dict(required=True, type='str', no_log=False),
-                password=dict(required=False, type='str', no_log=True),
-                state=dict(default='present', choices=['absent', 'present']),
-                update_password=dict(default='always', choices=['always',
-                                     'on_create']),
-                roles=dict(default=None, type='list')
-                ),
-            supports_check_mode=False
+            argument_spec=_ARGSPEC_USER,
+            supports_check_mode=True
             )
     user = module.params['user']
     password = module.params['password']
@@ -203,73 +275,78 @@ def main():
     update_password = module.params['update_password']
     roles = module.params['roles']
 
-    # Do an initial query for the user so we can inspect if it needs to change
-    subject_response = get_user(atlas_group_id, atlas_username, atlas_api_key,
-                                user)
-
-    if subject_response.get('error') is None:
-        subject_state = 'present'
-    # If we get a 404 we know the user is not there
-    elif subject_response.get('error') == 404:
-        subject_state = 'absent'
-    else:
-        module.fail_json(msg=str(subject_response))
+    _connect(atlas_username, atlas_api_key)
+
+    base_url = f"{_API_URL}/groups/{atlas_group_id}"
+
+    # Nothing may be changed in check mode, so look the user up and report
+    # what would happen
+    if module.check_mode:
+        subject_response = get_user(base_url, user)
+        if subject_response.get('error') == 404:
+            module.exit_json(changed=state == 'present', user=user)
+        elif subject_response.get('error') is not None:
+            module.fail_json(msg=str(subject_response))
+        elif state == 'absent':
+            module.exit_json(changed=True, user=subject_response)
+        else:
+            # The password always has to be sent, so it is always a change
+            changed = (update_password == 'always' and password is not None) \
+                or not roles_match(subject_response['roles'],
+                                   [map_roles(role) for role in roles])
+            module.exit_json(changed=changed, user=subject_response)
         return
 
-    # The user is not there so we must create it
-    if state == 'present' and subject_state == 'absent':
-        response = create_user(atlas_group_id=atlas_group_id,
-                               atlas_username=atlas_username,
-                               atlas_api_key=atlas_api_key,
-                               user=user, roles=roles, password=password)
+    # The user is not wanted. Delete it straight away; a 404 means it was
+    # never there, so there is no need to look it up first.
+    if state == 'absent':
+        response = delete_user(base_url, user)
         if response.get('error') is None:
             module.exit_json(changed=True, user=response)
+        elif response.get('error') == 404:
+            module.exit_json(changed=False, user=user)
         else:
-            module.fail_json(msg="Failed to create user:\n"+str(response))
+            module.fail_json(msg="Failed to delete user:\n"+str(response))
         return
 
-    # The user is not there and we don't want it there. Nothing to do here
-    if state == 'absent' and subject_state == 'absent':
-        module.exit_json(changed=False, user=user)
-        return
+    # Do an initial query for the user so we can inspect if it needs to change
+    subject_response = get_user(base_url, user)
 
-    # The user is there and we don't wait it to be. Delete it.
-    if state == 'absent' and subject_state == 'present':
-        response = delete_user(atlas_group_id, atlas_username, atlas_api_key,
-                               user)
+    # The user is not there so we must create it
+    if subject_response.get('error') == 404:
+        response = create_user(base_url=base_url,
+                               atlas_group_id=atlas_group_id, user=user,
+                               roles=roles, password=password)
         if response.get('error') is None:
             module.exit_json(changed=True, user=response)
         else:
-            module.fail_json(msg="Failed to delete user:\n"+str(response))
+            module.fail_json(msg="Failed to create user:\n"+str(response))
+        return
+    elif subject_response.get('error') is not None:
+        module.fail_json(msg=str(subject_response))
         return
 
     # The user is there and we want it to be.
-    if state == 'present' and subject_state == 'present':
-        # Need to update the password
-        # Note: we always have to update if the password is present because we
-        # cannot get the password though the API to compare it for change
-        if update_password == 'always' and password is not None:
-            response = sync_user(atlas_group_id=atlas_group_id,
-                                 atlas_username=atlas_username,
-                                 atlas_api_key=atlas_api_key,
-                                 user=user, http_response=subject_response,
-                                 roles=roles,
-                                 password=password)
-        # Not going to update the password
-        else:
-            response = sync_user(atlas_group_id=atlas_group_id,
-                                 atlas_username=atlas_username,
-                                 atlas_api_key=atlas_api_key,
-                                 roles=roles,
-                                 user=user, http_response=subject_response,
-                                 password=None)
-        if response.get('error') is None:
-            module.exit_json(changed=response['changed'],
-                             user=subject_response)
-        else:
-            module.fail_json(msg="Failed to update user:\n"+str(response),
-                             subject=subject_response)
-        return
+    # Need to update the password
+    # Note: we always have to update if the password is present because we
+    # cannot get the password though the API to compare it for change
+    if update_password == 'always' and password is not None:
+        response = sync_user(base_url=base_url, atlas_group_id=atlas_group_id,
+                             user=user, http_response=subject_response,
+                             roles=roles,
+                             password=password)
+    # Not going to update the password
+    else:
+        response = sync_user(base_url=base_url, atlas_group_id=atlas_group_id,
+                             roles=roles,
+                             user=user, http_response=subject_response,
+                             password=None)
+    if response.get('error') is None:
+        module.exit_json(changed=response['changed'],
+                         user=subject_response)
+    else:
+        module.fail_json(msg="Failed to update user:\n"+str(response),
+                         subject=subject_response)
 
 
 if __name__ == '__main__':